@@ -0,0 +1,431 @@
+"""Shared client for the BudgetKey API.
+
+Holds the pooled HTTP client, caches, retry policy and the dataset
+info/search/query coroutines used by the MCP tools in server.py.
+"""
+import os
+import asyncio
+import functools
+import logging
+import random
+import re
+import time
+import urllib.parse
+
+import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
+
+log = logging.getLogger(__name__)
+
+# Read configuration from environment variables
+BUDGETKEY_API_BASE = os.environ.get('BUDGETKEY_API_BASE', 'https://next.obudget.org')
+
+# Shared async HTTP client so connections to the upstream API are pooled and
+# reused (avoids a fresh TCP + TLS handshake on every tool call), and so
+# concurrent tool calls overlap on the event loop instead of each blocking a
+# worker thread on the network.
+HTTP = httpx.AsyncClient(
+    base_url=BUDGETKEY_API_BASE,
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    limits=httpx.Limits(max_connections=256, max_keepalive_connections=64, keepalive_expiry=60.0),
+    headers={'Accept-Encoding': 'zstd, br, gzip', 'Accept': 'application/json'},
+)
+
+# The datasets exposed by the upstream API; typos are rejected in-process
+# instead of paying an HTTP round-trip for a 404
+KNOWN_DATASETS = frozenset({
+    "budget_items_data",
+    "support_programs_data",
+    "supports_transactions_data",
+    "contracts_data",
+    "entities_data",
+    "income_items_data",
+    "budgetary_change_requests_data",
+    "budgetary_change_transactions_data",
+})
+
+# Validation failure response, built once: membership is O(1) on the
+# frozenset and the message doesn't need re-joining on every bad call
+INVALID_DATASET_ERROR = {
+    "error": "Invalid dataset. Must be one of: " + ", ".join(sorted(KNOWN_DATASETS)),
+}
+
+# Per-dataset request URLs (relative to the client's base_url), pre-built as
+# httpx.URL objects at import so hot-path calls do a dict lookup instead of
+# formatting and re-parsing the path. The query path stays a string prefix
+# because its querystring is appended per call.
+URLS = {
+    ds: {ep: httpx.URL(f"/api/tables/{ds}/{ep}") for ep in ("info", "search")}
+    for ds in KNOWN_DATASETS
+}
+QUERY_URLS = {ds: f"/api/tables/{ds}/query?" for ds in KNOWN_DATASETS}
+
+# Dataset schemas are effectively immutable within a session, so cache /info
+# responses in-process and skip the HTTP round-trip on repeat calls.
+# Error responses are never cached.
+INFO_CACHE = TTLCache(maxsize=32, ttl=3600)
+
+# Failed /info fetches are remembered briefly so a broken upstream doesn't
+# get hammered by an agent retry loop
+INFO_NEGATIVE_CACHE = TTLCache(maxsize=32, ttl=60)
+
+# Schemas also persist to disk so a restarted server starts warm instead of
+# paying cold-cache latency for every dataset again. Schemas change on the
+# timescale of days, hence the longer TTL; all disk I/O is best-effort.
+CACHE_DIR = os.environ.get('BUDGETKEY_CACHE_DIR', '/var/cache/budgetkey-mcp')
+DISK_CACHE_TTL = 24 * 3600
+
+
+def _disk_cache_path(dataset):
+    return os.path.join(CACHE_DIR, f"{dataset}-info.json")
+
+
+def _disk_cache_read(dataset):
+    try:
+        path = _disk_cache_path(dataset)
+        if time.time() - os.path.getmtime(path) > DISK_CACHE_TTL:
+            return None
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def _disk_cache_write(dataset, result):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(_disk_cache_path(dataset), 'wb') as f:
+            f.write(orjson.dumps(result))
+    except OSError as e:
+        log.warning("Could not persist dataset info for %s: %s", dataset, e)
+
+# LLM agents frequently re-issue identical searches and SQL queries within a
+# conversation, so keep a bounded LRU of results per tool. Entries are only
+# stored for clean responses (no error/warnings) below a size ceiling, and
+# queries with non-deterministic SQL are never cached.
+SEARCH_CACHE = LRUCache(maxsize=256)
+QUERY_CACHE = LRUCache(maxsize=256)
+MAX_CACHED_RESULT_SIZE = 1_000_000
+
+# Ceiling on /query response bodies: anything larger would be truncated or
+# rejected by the LLM anyway, so abort the download early and point the
+# caller at the download URL instead of buffering it all.
+MAX_QUERY_RESPONSE_SIZE = 2 * 1024 * 1024
+
+# Largest page a single query call may request; bigger result sets should go
+# through the download URL
+MAX_PAGE_SIZE = 500
+NON_DETERMINISTIC_SQL = re.compile(r'\b(now\s*\(|current_date|current_time|current_timestamp|random\s*\()', re.IGNORECASE)
+
+# A string literal ('' escapes a quote), a -- comment, or a /* */ comment.
+# Matching literals explicitly keeps ; and -- inside them from being
+# mistaken for statement separators or comments.
+SQL_LITERAL_OR_COMMENT = re.compile(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+def _strip_literals_and_comments(query):
+    """Blank out string literals and comments, keeping everything else."""
+    return SQL_LITERAL_OR_COMMENT.sub(
+        lambda m: "''" if m.group().startswith("'") else ' ', query)
+
+
+@functools.lru_cache(maxsize=512)
+def _lint_query(query: str):
+    """Cheap local checks on a SQL query, returning an error message or None.
+
+    Rejects non-SELECT and multi-statement input in-process, before paying
+    an upstream round-trip only to have the backend refuse the query.
+    Result-set size is already bounded by the page_size parameter, so no
+    LIMIT is injected.
+    """
+    stripped = _strip_literals_and_comments(query).strip().rstrip(';')
+    if ';' in stripped:
+        return "only a single SQL statement is allowed"
+    first_word = stripped.lstrip('(').split(None, 1)
+    if not first_word or first_word[0].lower() not in ('select', 'with'):
+        return "only SELECT queries are supported"
+    return None
+
+
+# Upper bound on simultaneous upstream requests, so agent fan-out cannot
+# pile enough load on the BudgetKey API to trigger rate limiting
+MAX_CONCURRENCY = int(os.environ.get('BUDGETKEY_MAX_CONCURRENCY', '16'))
+REQUEST_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# Retry policy for transient upstream failures: retryable status codes and
+# transport errors get exponential backoff with jitter (honoring Retry-After)
+# instead of surfacing as an opaque error that makes the LLM re-invoke the
+# tool blindly. Other 4xx responses are never retried.
+RETRY_STATUS_CODES = frozenset({408, 425, 429, 502, 503, 504})
+MAX_RETRIES = 4
+RETRY_BACKOFF = 0.5
+RETRY_JITTER = 0.5
+MAX_RETRY_DELAY = 15.0
+
+
+def _backoff_delay(attempt):
+    return min(RETRY_BACKOFF * (2 ** attempt), MAX_RETRY_DELAY) + random.uniform(0, RETRY_JITTER)
+
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_RETRY_DELAY)
+        except ValueError:
+            pass
+    return _backoff_delay(attempt)
+
+
+async def _with_retries(send):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await send()
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if attempt >= MAX_RETRIES or status not in RETRY_STATUS_CODES:
+                raise
+            delay = _retry_delay(e.response, attempt)
+            log.warning("Upstream returned %s, retrying in %.1fs (attempt %d/%d)",
+                        status, delay, attempt + 1, MAX_RETRIES)
+        except httpx.TransportError as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            delay = _backoff_delay(attempt)
+            log.warning("Transport error (%s), retrying in %.1fs (attempt %d/%d)",
+                        e, delay, attempt + 1, MAX_RETRIES)
+        await asyncio.sleep(delay)
+
+
+# Log the negotiated protocol once so deployments can verify HTTP/2
+# multiplexing is actually in effect against the upstream host
+_http_version_logged = False
+
+
+def _log_http_version(response):
+    global _http_version_logged
+    if not _http_version_logged:
+        _http_version_logged = True
+        log.info("Negotiated %s with %s", response.http_version, BUDGETKEY_API_BASE)
+
+
+# Responses that carried an ETag, kept so later calls can revalidate with
+# If-None-Match and a 304 instead of re-downloading the body
+ETAG_CACHE = LRUCache(maxsize=128)
+
+
+async def _get(url, params=None, timeout=30):
+    key = (url, tuple(sorted(params.items())) if params else None)
+    cached = ETAG_CACHE.get(key)
+    headers = {'If-None-Match': cached[0]} if cached else None
+
+    async def send():
+        async with REQUEST_SEMAPHORE:
+            response = await HTTP.get(url, params=params, timeout=timeout, headers=headers)
+        _log_http_version(response)
+        if cached is not None and response.status_code == 304:
+            log.info("ETag revalidated (304) for %.200s", url)
+            return cached[1]
+        response.raise_for_status()
+        etag = response.headers.get('ETag')
+        if etag:
+            ETAG_CACHE[key] = (etag, response)
+        return response
+
+    return await _with_retries(send)
+
+
+# Single-flight map: concurrent identical calls (e.g. parallel tool
+# invocations racing on a cold cache) share one upstream request instead of
+# each firing their own.
+INFLIGHT = {}
+
+
+async def _single_flight(key, fetch):
+    fut = INFLIGHT.get(key)
+    if fut is not None:
+        return await fut
+    fut = asyncio.get_running_loop().create_future()
+    INFLIGHT[key] = fut
+    try:
+        result = await fetch()
+        fut.set_result(result)
+        return result
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark as retrieved even if no other caller awaits
+        raise
+    finally:
+        INFLIGHT.pop(key, None)
+
+
+# LLM-issued search queries often differ only in whitespace or casing;
+# normalize them so such near-duplicates share one cache entry.
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _normalize_q(q: str) -> str:
+    return _WHITESPACE.sub(' ', q).strip().casefold()
+
+
+def _cache_get(cache, key):
+    result = cache.get(key)
+    log.info("X-Cache: %s for %.200s", "HIT" if result is not None else "MISS", key)
+    return result
+
+
+# Parsing a multi-hundred-KB body is synchronous C code that stalls the event
+# loop for every other in-flight call; push big parses to a thread. Small
+# payloads parse inline since the thread hop would cost more than the parse.
+PARSE_OFFLOAD_THRESHOLD = 512 * 1024
+
+
+async def _parse_json(data):
+    if len(data) > PARSE_OFFLOAD_THRESHOLD:
+        return await asyncio.to_thread(orjson.loads, data)
+    return orjson.loads(data)
+
+
+def _cache_put(cache, key, result):
+    if "error" in result or result.get("warnings"):
+        return
+    if len(orjson.dumps(result)) >= MAX_CACHED_RESULT_SIZE:
+        return
+    cache[key] = result
+
+
+async def dataset_info(dataset: str) -> dict:
+    if dataset not in KNOWN_DATASETS:
+        return INVALID_DATASET_ERROR
+    try:
+        if dataset in INFO_CACHE:
+            return INFO_CACHE[dataset]
+        negative = INFO_NEGATIVE_CACHE.get(dataset)
+        if negative is not None:
+            return negative
+        persisted = _disk_cache_read(dataset)
+        if persisted is not None:
+            INFO_CACHE[dataset] = persisted
+            return persisted
+
+        async def fetch():
+            url = URLS[dataset]["info"]
+            log.info("Fetching dataset info: %s", url)
+            response = await _get(url, timeout=30)
+            result = await _parse_json(response.content)
+            INFO_CACHE[dataset] = result
+            _disk_cache_write(dataset, result)
+            return result
+
+        return await _single_flight((URLS[dataset]["info"], ()), fetch)
+    except Exception as e:
+        log.error("Error fetching dataset info for %s: %s", dataset, e)
+        error = {"error": str(e)}
+        INFO_NEGATIVE_CACHE[dataset] = error
+        return error
+
+
+async def dataset_full_text_search(dataset: str, q: str) -> dict:
+    if dataset not in KNOWN_DATASETS:
+        return INVALID_DATASET_ERROR
+    try:
+        key = (dataset, _normalize_q(q))
+        cached = _cache_get(SEARCH_CACHE, key)
+        if cached is not None:
+            return cached
+
+        async def fetch():
+            url = URLS[dataset]["search"]
+            params = {"q": q}
+            log.info("Searching dataset %s: %s?q=%s", dataset, url, q)
+            response = await _get(url, params=params, timeout=30)
+            result = await _parse_json(response.content)
+            _cache_put(SEARCH_CACHE, key, result)
+            return result
+
+        return await _single_flight((URLS[dataset]["search"], (("q", key[1]),)), fetch)
+    except Exception as e:
+        log.error("Error searching dataset %s with query '%s': %s", dataset, q, e)
+        return {"error": str(e)}
+
+
+async def dataset_db_query(dataset: str, query: str, page_size: int = 50) -> dict:
+    if dataset not in KNOWN_DATASETS:
+        return INVALID_DATASET_ERROR
+    try:
+        problem = _lint_query(query)
+        if problem is not None:
+            return {"error": problem}
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        cacheable = not NON_DETERMINISTIC_SQL.search(query)
+        # Encode the querystring once: the resulting URL doubles as the cache
+        # and single-flight key, so identical calls share one encoding pass
+        qs = urllib.parse.urlencode({"query": query, "page_size": page_size})
+        url = QUERY_URLS[dataset] + qs
+        key = url
+        if cacheable:
+            cached = _cache_get(QUERY_CACHE, key)
+            if cached is not None:
+                return cached
+
+        async def fetch():
+            log.info("Querying dataset %s: %.100s...", dataset, query)
+            too_large = {
+                "warning": f"result too large (over {MAX_QUERY_RESPONSE_SIZE} bytes); "
+                           "narrow the query with WHERE/LIMIT or offer the download URL instead",
+            }
+
+            async def download():
+                async with REQUEST_SEMAPHORE, HTTP.stream("GET", url, timeout=60) as response:
+                    _log_http_version(response)
+                    response.raise_for_status()
+                    content_length = response.headers.get("Content-Length")
+                    if content_length and int(content_length) > MAX_QUERY_RESPONSE_SIZE:
+                        return dict(too_large, download_url=str(response.url)), response
+                    buf = bytearray()
+                    async for chunk in response.aiter_bytes(65536):
+                        buf.extend(chunk)
+                        if len(buf) > MAX_QUERY_RESPONSE_SIZE:
+                            return dict(too_large, download_url=str(response.url)), response
+                return buf, response
+
+            buf, response = await _with_retries(download)
+            if isinstance(buf, dict):
+                return buf
+            log.info("Query response: %d bytes decoded (encoding: %s)",
+                     len(buf), response.headers.get('content-encoding', 'identity'))
+            result = await _parse_json(bytes(buf))
+            if cacheable:
+                _cache_put(QUERY_CACHE, key, result)
+            return result
+
+        result = await _single_flight((url, ()), fetch)
+
+        # Add download URL info if available
+        if "download_url" in result:
+            log.info("Download URL available: %s", result['download_url'])
+
+        return result
+    except Exception as e:
+        log.error("Error querying dataset %s: %s", dataset, e)
+        return {"error": str(e)}
+
+
+async def warmup():
+    """Open the upstream connection at startup so the first tool call doesn't
+    pay for DNS resolution plus the TCP and TLS handshakes."""
+    try:
+        response = await HTTP.get("/", timeout=5)
+        if response.is_success:
+            log.info("Warmed up connection to %s (%s)", BUDGETKEY_API_BASE, response.status_code)
+        else:
+            log.warning("Warm-up request to %s returned %s; check BUDGETKEY_API_BASE",
+                        BUDGETKEY_API_BASE, response.status_code)
+    except Exception as e:
+        log.warning("Warm-up request to %s failed: %s", BUDGETKEY_API_BASE, e)
+
+
+async def close():
+    await HTTP.aclose()
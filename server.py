@@ -1,66 +1,36 @@
 import os
+import asyncio
 import logging
+from contextlib import asynccontextmanager
+from pathlib import Path
 
-import requests
 from fastmcp import FastMCP
 from fastmcp.tools.tool import ToolAnnotations
 from starlette.responses import Response
 
-# Set up logging
+import api_client
+
+# uvloop cuts per-socket overhead on the event loop; fall back to the stdlib
+# loop where it isn't available (e.g. Windows dev machines)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+# Set up logging (BUDGETKEY_LOG_LEVEL lets production runs silence the
+# per-call INFO lines entirely, skipping their formatting cost)
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.environ.get('BUDGETKEY_LOG_LEVEL', 'INFO').upper(),
     format='%(levelname)s: %(asctime)s : %(message)s',
     handlers=[logging.StreamHandler()]
 )
 log = logging.getLogger(__name__)
 
-# Read configuration from environment variables
-BUDGETKEY_API_BASE = os.environ.get('BUDGETKEY_API_BASE', 'https://next.obudget.org')
-
-# MCP Server instructions
-MCP_INSTRUCTIONS = """You are an expert data researcher, helping to find information on issues related to the State Budget of Israel. You provide information from the Israeli budget book (ספר התקציב הישראלי), budgetary support data (נתוני תמיכות תקציביות), information on contracts (התקשרויות), and tenders (מכרזים).
-
-You communicate efficiently in Hebrew.
-You use only the information obtained through the tools provided and no other information.
-
-The current year is 2025.
-Budget data is available from 1997 to 2025.
-
-## Available Datasets (מאגרי המידע)
-
-- budget_items_data: Data from the budget book (ספר התקציב), detailing the planned and executed expense budget of the state of Israel (תקציב המדינה).
-- support_programs_data: Data on budgetary support programs (נתונים על תוכניות תמיכה תקציביות)
-- supports_transactions_data: Data on individual payments for budgetary supports (נתונים על תשלומים במסגרת תמיכות תקציביות)
-- contracts_data: Data on the government's procurement contracts (נתונים על התקשרויות רכש)
-- entities_data: Data on corporations, companies, associations, local authorities, etc. (נתונים על תאגידים, חברות, עמותות, רשויות מקומיות וכו׳)
-- income_items_data: Data on state revenues (נתונים על הכנסות המדינה)
-- budgetary_change_requests_data: Data on budgetary change requests (נתונים על בקשות לשינויי/העברות תקציביות)
-- budgetary_change_transactions_data: Details for all individual changes/transactions on budgetary change requests (פרטי שינויי/העברות תקציביות)
-
-## Tool Usage
-
-- **DatasetInfo**: Use FIRST to understand any dataset's structure and schema before querying or searching it.
-- **DatasetFullTextSearch**: Use to locate relevant items and identifiers through free-text search (not for time periods).
-- **DatasetDBQuery**: Use to execute SQL queries and obtain comprehensive, precise information from datasets.
-
-## Workflow
 
-1. Identify entities and time periods mentioned in the question. Explain your understanding to the user.
-2. Call DatasetInfo for each dataset you plan to use.
-3. Call DatasetFullTextSearch if you need to find specific identifiers. AVOID calling more than 4 tools in parallel.
-4. Call DatasetDBQuery to get the final results.
-5. Present results professionally with data links and download options.
-6. Suggest relevant follow-up questions.
-
-## Response Guidelines
-
-- Respond formally and professionally in Hebrew or English
-- Always specify time periods for your data
-- If the user hasn't specified a time period, limit to current or previous year and mention this
-- Ask clarifying questions when information is insufficient
-- For irrelevant questions, politely decline to answer
-- Always suggest further research directions when applicable
-"""
+# MCP Server instructions, kept in a standalone text file so the (mostly
+# Hebrew) prose is not baked into Python source and is loaded once at import
+MCP_INSTRUCTIONS = (Path(__file__).parent / 'instructions.txt').read_text(encoding='utf-8')
 
 ANNOTATIONS = ToolAnnotations(
     readOnlyHint=True,
@@ -76,7 +46,7 @@ mcp = FastMCP(
 
 
 @mcp.tool(annotations=ANNOTATIONS)
-def DatasetInfo(dataset: str) -> dict:
+async def DatasetInfo(dataset: str) -> dict:
     """
     Get comprehensive information about a dataset, including its columns and database schema.
 
@@ -111,19 +81,11 @@ def DatasetInfo(dataset: str) -> dict:
     Returns:
         Dataset information including columns, schema, and field descriptions
     """
-    try:
-        url = f"{BUDGETKEY_API_BASE}/api/tables/{dataset}/info"
-        log.info(f"Fetching dataset info: {url}")
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        log.error(f"Error fetching dataset info for {dataset}: {e}")
-        return {"error": str(e)}
+    return await api_client.dataset_info(dataset)
 
 
 @mcp.tool(annotations=ANNOTATIONS)
-def DatasetFullTextSearch(dataset: str, q: str) -> dict:
+async def DatasetFullTextSearch(dataset: str, q: str) -> dict:
     """
     Perform full-text search on a dataset to locate relevant items and identifiers.
 
@@ -164,20 +126,11 @@ def DatasetFullTextSearch(dataset: str, q: str) -> dict:
     Returns:
         Search results with matching items and their identifiers
     """
-    try:
-        url = f"{BUDGETKEY_API_BASE}/api/tables/{dataset}/search"
-        params = {"q": q}
-        log.info(f"Searching dataset {dataset}: {url}?q={q}")
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        log.error(f"Error searching dataset {dataset} with query '{q}': {e}")
-        return {"error": str(e)}
+    return await api_client.dataset_full_text_search(dataset, q)
 
 
 @mcp.tool(annotations=ANNOTATIONS)
-def DatasetDBQuery(dataset: str, query: str, page_size: int = 50) -> dict:
+async def DatasetDBQuery(dataset: str, query: str, page_size: int = 50) -> dict:
     """
     Execute PostgreSQL-compatible SQL queries to obtain comprehensive, precise information from datasets.
 
@@ -236,32 +189,108 @@ def DatasetDBQuery(dataset: str, query: str, page_size: int = 50) -> dict:
         - download_url: Link to download full dataset (offer this to users as markdown link)
         - warnings: Any warnings about the query (must fix and re-run if present)
     """
-    try:
-        url = f"{BUDGETKEY_API_BASE}/api/tables/{dataset}/query"
-        params = {
-            "query": query,
-            "page_size": page_size
-        }
-        log.info(f"Querying dataset {dataset}: {query[:100]}...")
-        response = requests.get(url, params=params, timeout=60)
-        response.raise_for_status()
-        result = response.json()
-
-        # Add download URL info if available
-        if "download_url" in result:
-            log.info(f"Download URL available: {result['download_url']}")
-
-        return result
-    except Exception as e:
-        log.error(f"Error querying dataset {dataset}: {e}")
-        return {"error": str(e)}
+    return await api_client.dataset_db_query(dataset, query, page_size)
+
+
+# Dispatch table for BatchExecute
+BATCH_TOOLS = {
+    "DatasetInfo": api_client.dataset_info,
+    "DatasetFullTextSearch": api_client.dataset_full_text_search,
+    "DatasetDBQuery": api_client.dataset_db_query,
+}
+
+
+@mcp.tool(annotations=ANNOTATIONS)
+async def BatchExecute(calls: list[dict], max_concurrent: int = 4, stop_on_error: bool = False) -> list[dict]:
+    """
+    Execute multiple tool calls in a single request, running them in parallel on the server.
+
+    **Purpose**: Use this tool to batch several DatasetInfo / DatasetFullTextSearch / DatasetDBQuery
+    calls into ONE round-trip instead of issuing them as separate parallel tool calls.
+    This is the preferred way to fetch schema information for several datasets at once.
+
+    **Usage Instructions**:
+    1. Build a list of calls, each of the form {"tool": "<tool name>", "args": {...}}
+    2. Valid tool names: DatasetInfo, DatasetFullTextSearch, DatasetDBQuery
+    3. Results are returned in the same order as the input calls
+    4. Check the "ok" flag on each result before using it
+
+    **When to use**:
+    - Calling DatasetInfo for every dataset you plan to use in one shot
+    - Running several independent searches or queries together
+
+    Args:
+        calls: List of calls to execute, e.g.
+               [{"tool": "DatasetInfo", "args": {"dataset": "budget_items_data"}},
+                {"tool": "DatasetFullTextSearch", "args": {"dataset": "entities_data", "q": "משרד החינוך"}}]
+        max_concurrent: Maximum number of calls executed in parallel (default: 4)
+        stop_on_error: If true, calls that have not started yet are skipped after the first failure
+
+    Returns:
+        List of results, one per call and in the same order:
+        - {"ok": true, "result": ...} for successful calls
+        - {"ok": false, "error": "..."} for failed (or skipped) calls
+    """
+    sem = asyncio.Semaphore(max(1, max_concurrent))
+    failed = asyncio.Event()
+
+    async def run(call):
+        tool = call.get("tool")
+        fn = BATCH_TOOLS.get(tool)
+        if fn is None:
+            return {"ok": False, "error": f"Unknown tool: {tool}. Valid tools: {', '.join(BATCH_TOOLS)}"}
+        async with sem:
+            if stop_on_error and failed.is_set():
+                return {"ok": False, "error": "Skipped: a previous call failed"}
+            try:
+                result = await fn(**call.get("args", {}))
+            except Exception as e:
+                result = {"error": str(e)}
+        if isinstance(result, dict) and "error" in result:
+            failed.set()
+            return {"ok": False, "error": result["error"]}
+        return {"ok": True, "result": result}
+
+    return list(await asyncio.gather(*[run(call) for call in calls]))
+
+
+# Health response body built once; probes hit this endpoint every few seconds
+# per replica, so don't rebuild it per request
+_HEALTH_BODY = b'{"status": "healthy"}'
+_HEALTH_HEADERS = {"Cache-Control": "no-cache"}
 
 
 @mcp.custom_route('/mcp/health', methods=['GET'])
 async def health_check(request):
     """Health check endpoint for Kubernetes probes"""
-    return Response('{"status": "healthy"}', media_type="application/json")
+    return Response(_HEALTH_BODY, media_type="application/json", headers=_HEALTH_HEADERS)
+
+
+# ASGI app for uvicorn; stateless HTTP mode lets any worker serve any client,
+# so the server can fan out across multiple processes
+app = mcp.http_app(path='/mcp', stateless_http=True)
+
+# Warm up and close the shared HTTP client with the *process*, not with each
+# MCP session: in stateless mode FastMCP runs its own lifespan per session,
+# which would close the client after the first one. Wrap the app's ASGI
+# lifespan instead, so warmup/close fire exactly once per worker.
+_mcp_lifespan = app.router.lifespan_context
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await api_client.warmup()
+    try:
+        async with _mcp_lifespan(app):
+            yield
+    finally:
+        await api_client.close()
+
+
+app.router.lifespan_context = lifespan
 
 
 if __name__ == "__main__":
-    mcp.run(transport='streamable-http', path='/mcp', host="0.0.0.0", port=8000)
+    import uvicorn
+    uvicorn.run("server:app", host="0.0.0.0", port=8000,
+                workers=int(os.environ.get("WEB_CONCURRENCY", "1")))